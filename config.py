@@ -7,9 +7,19 @@ DEFAULT_CONFIG = {
     "MAX_FILE_SIZE_MB": 70,
     "MIN_VALID_FILE_SIZE_BYTES": 200 * 1024,
     "FORCE_REENCODE_TT": True,
+    "FFMPEG_PRESET": "faster",
+    "AUDIO_CODEC": "mp3",
     "YT_COOKIE_PATH": "/app/cookies_youtube.txt",
     "YT_COOKIES_B64": "",
-    "TIMEOUT_SECONDS": 120
+    "ALLOWED_IDS": "",
+    "YT_DLP_CACHE_DIR": "/tmp/yt-dlp-cache",
+    "TIMEOUT_SECONDS": 120,
+    "DOWNLOAD_TIMEOUT_SECONDS": 900,
+    "ENCODE_TIMEOUT_SECONDS": 900,
+    "CONCURRENT_FRAGMENTS": 8,
+    "MAX_CONCURRENT_JOBS": 4,
+    "SENT_CACHE_SIZE": 64,
+    "SENT_CACHE_TTL_SECONDS": 900
 }
 
 def load_config() -> Dict:
@@ -23,10 +33,11 @@ def load_config() -> Dict:
     for key in config:
         env_val = os.getenv(key)
         if env_val is not None:
-            if isinstance(config[key], int):
-                config[key] = int(env_val)
-            elif isinstance(config[key], bool):
+            # bool لازم قبل int لأن bool فرع من int
+            if isinstance(config[key], bool):
                 config[key] = env_val.lower() in ('true', '1')
+            elif isinstance(config[key], int):
+                config[key] = int(env_val)
             else:
                 config[key] = env_val
     return config
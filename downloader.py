@@ -1,60 +1,190 @@
-import ffmpeg, asyncio, logging
+import asyncio, json, logging, subprocess, os, time
 from pathlib import Path
+from typing import Dict, Optional
 from .config import CONFIG
 from .cookies import YOUTUBE_COOKIES_AVAILABLE, YT_COOKIE_PATH
-from .utils import is_valid_file
+from .utils import run_cmd, is_valid_file, is_tiktok
+
+logger = logging.getLogger(__name__)
 
 MAX_FILE_SIZE_MB = CONFIG["MAX_FILE_SIZE_MB"]
 FORCE_REENCODE_TT = CONFIG["FORCE_REENCODE_TT"]
+YT_DLP_CACHE_DIR = CONFIG["YT_DLP_CACHE_DIR"]
+FFMPEG_PRESET = CONFIG["FFMPEG_PRESET"]
+AUDIO_CODEC = CONFIG["AUDIO_CODEC"]
+AUDIO_EXT = ".m4a" if AUDIO_CODEC == "aac" else ".mp3"
+# التنزيل والترميز ممكن ياخدوا دقايق على ملف 70MB، فمهلتهم أطول من TIMEOUT_SECONDS
+DOWNLOAD_TIMEOUT_SECONDS = CONFIG["DOWNLOAD_TIMEOUT_SECONDS"]
+ENCODE_TIMEOUT_SECONDS = CONFIG["ENCODE_TIMEOUT_SECONDS"]
 
-def build_yt_dlp_cmd(url: str, out_path: Path, as_audio: bool = False):
-    """بناء أمر yt-dlp"""
-    is_tiktok = "tiktok.com" in url
-    if is_tiktok:
-        return [
-            "yt-dlp", "-f", "mp4*+m4a/best[ext=mp4]/best",
-            "--merge-output-format", "mp4", "--no-warnings",
-            "--concurrent-fragments", "4", "--retries", "10",
-            "--fragment-retries", "10", "--socket-timeout", "30",
-            "--user-agent", "Mozilla/5.0", "--add-header", "Referer:https://www.tiktok.com/",
-            "-o", str(out_path), url,
-        ]
-    else:
-        fmt = f"b[filesize<{MAX_FILE_SIZE_MB}M]/bv*+ba/best" if not as_audio else "bestaudio[abr<=128k]/bestaudio"
-        cmd = [
-            "yt-dlp", "-f", fmt, "--no-warnings", "--restrict-filenames",
-            "--concurrent-fragments", "4", "--retries", "10", "--fragment-retries", "10",
-            "--socket-timeout", "30", "--geo-bypass", "--encoding", "utf-8",
-            "--user-agent", "Mozilla/5.0", "--extractor-args", "youtube:player_client=android",
-            "-o", str(out_path), url,
-        ]
-        if YOUTUBE_COOKIES_AVAILABLE:
-            cmd += ["--cookies", str(YT_COOKIE_PATH)]
-        return cmd
-
-async def reencode_to_mp4(in_path: Path, out_path: Path):
-    """إعادة ترميز MP4"""
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+def available_cpus() -> int:
+    """عدد الأنوية المتاحة للعملية (يحترم حدود الـ container)"""
     try:
-        await asyncio.to_thread(
-            lambda: ffmpeg.input(str(in_path)).output(
-                str(out_path), vcodec="libx264", pix_fmt="yuv420p", preset="veryfast",
-                movflags="+faststart", acodec="aac"
-            ).run(overwrite_output=True, quiet=True)
-        )
-        return is_valid_file(out_path)
-    except Exception as e:
-        logging.exception("FFmpeg error: %s", e)
-        return False
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+CPU_COUNT = available_cpus()
+ENCODE_SLOTS = max(1, CPU_COUNT // 2)
+# الأنوية بتتقسم على الترميزات المتزامنة عشان مجموع threads الـ x264 ميزيدش عن CPU_COUNT
+X264_THREADS = max(1, CPU_COUNT // ENCODE_SLOTS)
+_ENCODE_SEM = asyncio.Semaphore(ENCODE_SLOTS)
+CONCURRENT_FRAGMENTS = str(CONFIG["CONCURRENT_FRAGMENTS"])
 
-async def convert_to_mp3(in_path: Path, out_path: Path):
-    """تحويل إلى MP3"""
+def detect_h264_encoder() -> str:
+    """اختيار مرمّز H.264 بالترتيب: NVENC > QSV > VAAPI > libx264"""
     try:
-        await asyncio.to_thread(
-            lambda: ffmpeg.input(str(in_path)).output(
-                str(out_path), acodec="libmp3lame", audio_bitrate="128k"
-            ).run(overwrite_output=True, quiet=True)
-        )
-        return is_valid_file(out_path)
+        out = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True, check=True
+        ).stdout
     except Exception as e:
-        logging.exception("FFmpeg error: %s", e)
-        return False
+        logger.warning("Could not list ffmpeg encoders: %s", e)
+        return "libx264"
+    if "h264_nvenc" in out:
+        return "h264_nvenc"
+    if "h264_qsv" in out:
+        return "h264_qsv"
+    if "h264_vaapi" in out and Path(VAAPI_DEVICE).exists():
+        return "h264_vaapi"
+    return "libx264"
+
+H264_ENCODER = detect_h264_encoder()
+logger.info("H.264 encoder: %s", H264_ENCODER)
+
+SHORT_CLIP_SECONDS = 10
+
+def h264_encode_args(encoder: str, duration: float = 0.0):
+    """خيارات ffmpeg قبل وبعد -i لكل مرمّز"""
+    if encoder == "h264_nvenc":
+        return (
+            ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"],
+            ["-c:v", "h264_nvenc", "-vf", "scale_cuda=format=yuv420p", "-preset", "p4", "-rc", "vbr", "-cq", "23", "-b:v", "0"],
+        )
+    if encoder == "h264_qsv":
+        return (
+            ["-hwaccel", "qsv"],
+            ["-c:v", "h264_qsv", "-pix_fmt", "nv12", "-global_quality", "23"],
+        )
+    if encoder == "h264_vaapi":
+        return (
+            ["-vaapi_device", VAAPI_DEVICE, "-hwaccel", "vaapi", "-hwaccel_output_format", "vaapi"],
+            ["-c:v", "h264_vaapi", "-vf", "format=nv12|vaapi,hwupload"],
+        )
+    # المقاطع القصيرة: ultrafast لأن وقت تجهيز x264 بيغلب والحجم مش مشكلة
+    preset = "ultrafast" if 0 < duration < SHORT_CLIP_SECONDS else FFMPEG_PRESET
+    # -hwaccel auto: فك الترميز على العتاد لو متاح، وإلا software تلقائيًا
+    return ["-hwaccel", "auto"], ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-preset", preset, "-threads", str(X264_THREADS)]
+
+_TIKTOK_BASE = (
+    "yt-dlp", "-f", "mp4*+m4a/best[ext=mp4]/best",
+    "--merge-output-format", "mp4", "--no-warnings", "--no-playlist",
+    "--concurrent-fragments", "4", "--retries", "10",
+    "--fragment-retries", "10", "--socket-timeout", "30", "--max-filesize", f"{MAX_FILE_SIZE_MB}M",
+    "--user-agent", "Mozilla/5.0", "--add-header", "Referer:https://www.tiktok.com/",
+    "--cache-dir", YT_DLP_CACHE_DIR, "--print", "after_move:filepath", "--no-simulate",
+)
+_YT_BASE = (
+    "yt-dlp", "--no-warnings", "--no-playlist", "--restrict-filenames",
+    "--concurrent-fragments", CONCURRENT_FRAGMENTS, "--http-chunk-size", "10M",
+    "--retries", "10", "--fragment-retries", "10",
+    "--socket-timeout", "30", "--geo-bypass", "--encoding", "utf-8", "--max-filesize", f"{MAX_FILE_SIZE_MB}M",
+    "--user-agent", "Mozilla/5.0", "--extractor-args", "youtube:player_client=android",
+    "--cache-dir", YT_DLP_CACHE_DIR, "--print", "after_move:filepath", "--no-simulate",
+) + (("--cookies", str(YT_COOKIE_PATH)) if YOUTUBE_COOKIES_AVAILABLE else ())
+_YT_VIDEO_FMT = f"b[filesize<{MAX_FILE_SIZE_MB}M]/bv*[filesize<{MAX_FILE_SIZE_MB}M]+ba/bv*+ba/best"
+# m4a (AAC) أولاً: الهاندلر بيبعته زي ما هو من غير تحويل
+_YT_AUDIO_FMT = "bestaudio[ext=m4a][abr<=160k]/bestaudio[ext=m4a]/bestaudio[abr<=128k]/bestaudio"
+
+def build_yt_dlp_cmd(url: str, out_path: Path, as_audio: bool = False, tiktok: Optional[bool] = None):
+    """بناء أمر yt-dlp (الأجزاء الثابتة محسوبة مرة واحدة)"""
+    if tiktok is None:
+        tiktok = is_tiktok(url)
+    if tiktok:
+        return [*_TIKTOK_BASE, "-o", str(out_path), url]
+    fmt = _YT_AUDIO_FMT if as_audio else _YT_VIDEO_FMT
+    return [*_YT_BASE, "-f", fmt, "-o", str(out_path), url]
+
+async def run_ffmpeg(args) -> bool:
+    """تشغيل ffmpeg مباشرة (بدون thread) تحت حد المهام المتزامنة"""
+    async with _ENCODE_SEM:
+        return await run_cmd(
+            ["ffmpeg", "-y", "-nostdin", "-hide_banner", "-loglevel", "error", *args], timeout=ENCODE_TIMEOUT_SECONDS
+        ) is not None
+
+async def probe_codecs(path: Path) -> Dict[str, str]:
+    """قراءة الكودكات والمدة بـ ffprobe: {"video", "pix_fmt", "audio", "duration"}"""
+    out = await run_cmd([
+        "ffprobe", "-v", "error", "-show_entries", "stream=codec_type,codec_name,pix_fmt:format=duration",
+        "-of", "json", str(path)
+    ])
+    codecs: Dict[str, str] = {}
+    try:
+        info = json.loads(out or "{}")
+    except ValueError:
+        return codecs
+    codecs["duration"] = info.get("format", {}).get("duration", "")
+    for st in info.get("streams", []):
+        kind = st.get("codec_type")
+        if kind == "video" and "video" not in codecs:
+            codecs["video"] = st.get("codec_name", "")
+            codecs["pix_fmt"] = st.get("pix_fmt", "")
+        elif kind == "audio" and "audio" not in codecs:
+            codecs["audio"] = st.get("codec_name", "")
+    return codecs
+
+def media_duration(codecs: Dict[str, str]) -> float:
+    """المدة بالثواني من نتيجة probe_codecs (0 لو مش معروفة)"""
+    try:
+        return float(codecs.get("duration") or 0)
+    except ValueError:
+        return 0.0
+
+def is_web_compatible(codecs: Dict[str, str]) -> bool:
+    """H.264/yuv420p مع AAC (أو بدون صوت) يكفيه remux"""
+    return (
+        codecs.get("video") == "h264" and codecs.get("pix_fmt") == "yuv420p"
+        and codecs.get("audio", "aac") == "aac"
+    )
+
+async def remux_faststart(in_path: Path, out_path: Path):
+    """نسخ الـ streams كما هي مع نقل الـ moov للبداية"""
+    ok = await run_ffmpeg(["-i", str(in_path), "-c", "copy", "-movflags", "+faststart", str(out_path)])
+    return ok and is_valid_file(out_path)
+
+# المرمّز العتادي بيتعطل بس بعد كذا فشل ورا بعض (libx264 نجح على نفس الملف في كل مرة)،
+# ولمدة محدودة: ملف واحد مش مدعوم (10-bit/HEVC) ميقفلش الـ GPU للأبد
+HW_FAILURES_BEFORE_DISABLE = 3
+HW_DISABLE_SECONDS = 600
+_hw_failures = 0
+_hw_disabled_until = 0.0
+
+async def reencode_to_mp4(in_path: Path, out_path: Path, duration: float = 0.0):
+    """إعادة ترميز MP4 (مع الرجوع لـ libx264 لو فشل المرمّز العتادي)"""
+    global _hw_failures, _hw_disabled_until
+    hw = H264_ENCODER != "libx264" and time.monotonic() >= _hw_disabled_until
+    encoders = [H264_ENCODER, "libx264"] if hw else ["libx264"]
+    for encoder in encoders:
+        in_args, out_args = h264_encode_args(encoder, duration)
+        if await run_ffmpeg([*in_args, "-i", str(in_path), *out_args, "-c:a", "aac", "-movflags", "+faststart", str(out_path)]):
+            if hw and encoder == H264_ENCODER:
+                _hw_failures = 0
+            elif hw:
+                _hw_failures += 1
+                if _hw_failures >= HW_FAILURES_BEFORE_DISABLE:
+                    _hw_failures = 0
+                    _hw_disabled_until = time.monotonic() + HW_DISABLE_SECONDS
+                    logger.warning("Disabling %s for %ds after repeated failures", H264_ENCODER, HW_DISABLE_SECONDS)
+            return is_valid_file(out_path)
+        logger.warning("FFmpeg re-encode failed with %s", encoder)
+    return False
+
+async def convert_audio(in_path: Path, out_path: Path):
+    """تحويل لصوت فقط: AAC (m4a) أو MP3 (VBR ~130kbps) حسب AUDIO_CODEC"""
+    if AUDIO_CODEC == "aac":
+        codec_args = ["-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart"]
+    else:
+        codec_args = ["-c:a", "libmp3lame", "-compression_level", "7", "-q:a", "5"]
+    ok = await run_ffmpeg(["-i", str(in_path), "-vn", *codec_args, str(out_path)])
+    return ok and is_valid_file(out_path)
@@ -1,27 +1,80 @@
-import re, hashlib, logging
+import re, time, asyncio, hashlib, logging
+from collections import OrderedDict
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from typing import Optional, Tuple
 from telegram import Update
 from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
-from .downloader import build_yt_dlp_cmd, reencode_to_mp4, convert_to_mp3
-from .utils import run_blocking_cmd, is_valid_file
+from .downloader import (
+    build_yt_dlp_cmd, DOWNLOAD_TIMEOUT_SECONDS, probe_codecs, media_duration, is_web_compatible, remux_faststart, reencode_to_mp4, convert_audio, AUDIO_EXT
+)
+from .utils import run_cmd, is_valid_file, is_tiktok, scratch_dir
 from .config import CONFIG
 
+logger = logging.getLogger(__name__)
+
 URL_RE = re.compile(r"(https?://\S+)", re.IGNORECASE)
-ALLOWED_IDS = {int(x) for x in (CONFIG.get("ALLOWED_IDS", "").split()) if x.isdigit()}
+AUDIO_KEYWORDS = ("mp3", "صوت")
+ALLOWED_IDS = frozenset(int(x) for x in CONFIG["ALLOWED_IDS"].replace(",", " ").split() if x.isdigit())
+_ACL_ENFORCED = bool(ALLOWED_IDS)
+
+AUDIO_SUFFIXES = frozenset({".mp3", ".m4a", ".aac", ".ogg"})
+NOCONVERT_SUFFIXES = frozenset({".mp3", ".m4a"})
+
+NOT_ALLOWED_TEXT = "🚫 غير مسموح."
+DOWNLOADING_TEXT = "⏳ جاري التنزيل..."
+UPLOADING_TEXT = "⬆️ جاري الرفع..."
+
+SENT_CACHE_SIZE = CONFIG["SENT_CACHE_SIZE"]
+SENT_CACHE_TTL_SECONDS = CONFIG["SENT_CACHE_TTL_SECONDS"]
+# (url, as_audio) -> (وقت الإرسال, file_id, صوت؟, الكابشن)
+_sent_cache: "OrderedDict[Tuple[str, bool], Tuple[float, str, bool, str]]" = OrderedDict()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"أرسل رابط يوتيوب/تيك توك.\n- أكتب mp3 مع الرابط لو عايز صوت فقط.\n- الحد الأقصى: {CONFIG['MAX_FILE_SIZE_MB']}MB.")
+    await update.message.reply_text(f"أرسل رابط يوتيوب/تيك توك.\n- أكتب mp3 أو صوت مع الرابط لو عايز صوت فقط.\n- الحد الأقصى: {CONFIG['MAX_FILE_SIZE_MB']}MB.")
 
 def is_authorized(update: Update):
-    if not ALLOWED_IDS:
+    if not _ACL_ENFORCED:
         return True
-    return update.effective_user and update.effective_user.id in ALLOWED_IDS
+    user = update.effective_user
+    return user is not None and user.id in ALLOWED_IDS
+
+def cache_get(key: Tuple[str, bool]) -> Optional[Tuple[float, str, bool, str]]:
+    """file_id لملف اتبعت قبل كده لنفس الرابط (LRU مع TTL)"""
+    entry = _sent_cache.get(key)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[0] > SENT_CACHE_TTL_SECONDS:
+        del _sent_cache[key]
+        return None
+    _sent_cache.move_to_end(key)
+    return entry
+
+def cache_put(key: Tuple[str, bool], file_id: str, is_audio: bool, caption: str):
+    if SENT_CACHE_SIZE <= 0:
+        return
+    _sent_cache[key] = (time.monotonic(), file_id, is_audio, caption)
+    _sent_cache.move_to_end(key)
+    while len(_sent_cache) > SENT_CACHE_SIZE:
+        _sent_cache.popitem(last=False)
+
+async def edit_status(message, text: str):
+    """تعديل رسالة الحالة؛ فشلها (rate limit مثلاً) ميأثرش على الإرسال"""
+    try:
+        await message.edit_text(text)
+    except Exception as e:
+        logger.warning("Status edit failed: %s", e)
+
+def find_downloaded_file(output: str) -> Optional[Path]:
+    """مسار الملف كما طبعه yt-dlp (after_move:filepath)"""
+    lines = output.strip().splitlines()
+    if lines and is_valid_file(Path(lines[-1])):
+        return Path(lines[-1])
+    return None
 
 async def handle_media_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_authorized(update):
-        await update.message.reply_text("🚫 غير مسموح.")
+        await update.message.reply_text(NOT_ALLOWED_TEXT)
         return
 
     text = (update.effective_message.text or "").strip()
@@ -31,58 +84,103 @@ async def handle_media_request(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     url = m.group(1)
-    is_tiktok = "tiktok.com" in url
-    as_audio = "mp3" in text.lower()
+    tiktok = is_tiktok(url)
+    # نبحث في النص برا الرابط بس، عشان "mp3" جوه الرابط نفسه متتحسبش
+    rest = (text[:m.start()] + text[m.end():]).casefold()
+    as_audio = any(k in rest for k in AUDIO_KEYWORDS)
+
+    # نفس الرابط اتبعت قريب: تيليجرام عنده الملف، نبعت الـ file_id من غير تنزيل ولا رفع
+    cache_key = (url, as_audio)
+    cached = cache_get(cache_key)
+    if cached:
+        _, file_id, cached_audio, caption = cached
+        try:
+            if cached_audio:
+                await update.message.reply_audio(audio=file_id, caption=caption)
+            else:
+                await update.message.reply_video(video=file_id, caption=caption)
+            return
+        except Exception as e:
+            logger.warning("Cached file_id send failed, downloading again: %s", e)
+            _sent_cache.pop(cache_key, None)
 
-    with TemporaryDirectory(prefix="tg_dl_", dir="/tmp") as tmp:
-        temp_dir = Path(tmp)
-        base_filename = f"media_{hashlib.md5(url.encode()).hexdigest()[:10]}_{update.effective_message.id}"
-        output_template = temp_dir / (base_filename + (".%(ext)s" if not is_tiktok else ".mp4"))
+    async with scratch_dir() as temp_dir:
+        base_filename = f"media_{hashlib.blake2b(url.encode(), digest_size=5).hexdigest()}_{update.effective_message.id}"
+        output_template = temp_dir / (base_filename + (".%(ext)s" if not tiktok else ".mp4"))
 
-        await update.effective_chat.send_action(ChatAction.TYPING)
-        status_message = await update.message.reply_text("⏳ جاري التنزيل...")
+        # نبدأ yt-dlp قبل رسائل الحالة عشان رحلات تيليجرام تتم أثناء التنزيل
+        download_task = asyncio.create_task(run_cmd(
+            build_yt_dlp_cmd(url, output_template, as_audio, tiktok), timeout=DOWNLOAD_TIMEOUT_SECONDS
+        ))
+        try:
+            _, status_message = await asyncio.gather(
+                update.effective_chat.send_action(ChatAction.TYPING),
+                update.message.reply_text(DOWNLOADING_TEXT),
+            )
+        except Exception:
+            await download_task
+            raise
 
         try:
-            cmd = build_yt_dlp_cmd(url, output_template, as_audio)
-            result_output = await run_blocking_cmd(cmd)
+            result_output = await download_task
 
-            if not result_output:
+            if result_output is None:
                 await status_message.edit_text("❌ فشل التنزيل. قد يكون الرابط خاص أو غير متوفر.")
                 return
 
-            downloaded_files = sorted(temp_dir.glob(f"{base_filename}*"), key=lambda p: p.stat().st_mtime, reverse=True)
-            final_file = next((f for f in downloaded_files if is_valid_file(f)), None)
+            if not result_output.strip():
+                # --max-filesize بيتخطى التحميل بدون ما يطبع مسار
+                await status_message.edit_text(f"⚠️ الملف أكبر من {CONFIG['MAX_FILE_SIZE_MB']}MB أو غير متاح.")
+                return
+
+            final_file = await asyncio.to_thread(find_downloaded_file, result_output)
 
             if not final_file:
                 await status_message.edit_text("❌ الملف الناتج غير صالح.")
                 return
 
             processed_file = final_file
-            if is_tiktok and CONFIG["FORCE_REENCODE_TT"]:
+            if tiktok and CONFIG["FORCE_REENCODE_TT"]:
                 fixed_path = temp_dir / f"{base_filename}_fixed.mp4"
-                if await reencode_to_mp4(final_file, fixed_path):
+                codecs = await probe_codecs(final_file)
+                if is_web_compatible(codecs):
+                    fixed = await remux_faststart(final_file, fixed_path)
+                else:
+                    fixed = await reencode_to_mp4(final_file, fixed_path, media_duration(codecs))
+                if fixed:
                     processed_file = fixed_path
 
-            if not is_tiktok and as_audio and processed_file.suffix.lower() not in (".mp3", ".m4a"):
-                mp3_path = temp_dir / f"{base_filename}.mp3"
-                if await convert_to_mp3(processed_file, mp3_path):
-                    processed_file = mp3_path
+            suffix = processed_file.suffix.lower()
+            if not tiktok and as_audio and suffix not in NOCONVERT_SUFFIXES:
+                audio_path = temp_dir / f"{base_filename}{AUDIO_EXT}"
+                if await convert_audio(processed_file, audio_path):
+                    processed_file = audio_path
+                    suffix = AUDIO_EXT
 
             try:
-                size_mb = processed_file.stat().st_size / (1024 * 1024)
-                caption = f"تم ✅ الحجم: {size_mb:.1f}MB"
-
-                if processed_file.suffix.lower() in (".mp3", ".m4a", ".aac", ".ogg"):
-                    await update.message.reply_audio(audio=processed_file.open("rb"), caption=caption, filename=processed_file.name)
+                # InputFile في PTB 20 بيقرا الملف كله، فنقراه في thread بدل الـ event loop
+                data = await asyncio.to_thread(processed_file.read_bytes)
+                # البيانات في الذاكرة خلاص، نحرر الملف بدري (مهم لو الـ scratch على /dev/shm)
+                await asyncio.to_thread(processed_file.unlink, missing_ok=True)
+                caption = f"تم ✅ الحجم: {len(data) / (1024 * 1024):.1f}MB"
+
+                is_audio = suffix in AUDIO_SUFFIXES
+                if is_audio:
+                    send = update.message.reply_audio(audio=data, caption=caption, filename=processed_file.name)
                 else:
-                    await update.message.reply_video(video=processed_file.open("rb"), caption=caption, filename=processed_file.name)
+                    send = update.message.reply_video(video=data, caption=caption, filename=processed_file.name)
+                _, sent = await asyncio.gather(edit_status(status_message, UPLOADING_TEXT), send)
+
+                media = sent.audio if is_audio else sent.video
+                if media is not None:
+                    cache_put(cache_key, media.file_id, is_audio, caption)
 
                 await status_message.delete()
 
             except Exception as e:
-                logging.exception("Telegram send error: %s", e)
+                logger.exception("Telegram send error: %s", e)
                 await status_message.edit_text("⚠️ حدث خطأ أثناء إرسال الملف.")
 
         except Exception as e:
-            logging.exception("Unexpected error: %s", e)
+            logger.exception("Unexpected error: %s", e)
             await status_message.edit_text("⚠️ حصل خطأ غير متوقع.")
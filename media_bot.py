@@ -1,6 +1,14 @@
 import os
+import re
+import time
+import uuid
+import shutil
+import asyncio
 import logging
-import subprocess
+import tempfile
+import functools
+from collections import OrderedDict, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
@@ -15,78 +23,219 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ALLOWED_IDS = os.getenv("ALLOWED_IDS", "")
 MAX_MB = int(os.getenv("MAX_MB", "70"))
-
-# تحويل IDs لقائمة
-ALLOWED_IDS = [int(x) for x in ALLOWED_IDS.split(",") if x.strip().isdigit()]
+MAX_BYTES = MAX_MB * 1024 * 1024
+YT_DLP_CACHE_DIR = os.getenv("YT_DLP_CACHE_DIR", "/tmp/yt-dlp-cache")
+YT_DLP_WARMUP_URL = os.getenv("YT_DLP_WARMUP_URL", "https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+LOCK_WAIT_SECONDS = float(os.getenv("LOCK_WAIT_SECONDS", "3"))
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv("DOWNLOAD_TIMEOUT_SECONDS", "900"))
+SENT_CACHE_SIZE = int(os.getenv("SENT_CACHE_SIZE", "64"))
+SENT_CACHE_TTL_SECONDS = int(os.getenv("SENT_CACHE_TTL_SECONDS", "900"))
+
+# مجلد العمل: مجلد فرعي لكل طلب
+WORK_ROOT = os.path.join(tempfile.gettempdir(), "bot-scratch")
+
+# تحويل IDs لمجموعة ثابتة (مفصولة بفواصل أو مسافات)
+ALLOWED_IDS = frozenset(int(x) for x in ALLOWED_IDS.replace(",", " ").split() if x.isdigit())
+
+# regex الروابط (متجمّع مرة واحدة)
+URL_RE = re.compile(r"https?://\S+", re.IGNORECASE)
+
+# قفل لكل مستخدم: طلب واحد في نفس الوقت
+# الأقفال مبتتمسحش: المستخدمين محدودين بـ ALLOWED_IDS، والمسح وفيه طلب مستني كان بيسمح بطلبين مع بعض
+_user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+NOT_ALLOWED_TEXT = "❌ غير مسموح لك باستخدام هذا البوت."
+
+# url -> (وقت الإرسال, file_id): رابط اتبعت قريب نعيد إرساله من غير تحميل ولا رفع
+_sent_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+def cache_get(url: str) -> Optional[str]:
+    entry = _sent_cache.get(url)
+    if entry is None:
+        return None
+    if time.monotonic() - entry[0] > SENT_CACHE_TTL_SECONDS:
+        del _sent_cache[url]
+        return None
+    _sent_cache.move_to_end(url)
+    return entry[1]
+
+def cache_put(url: str, file_id: str):
+    if SENT_CACHE_SIZE <= 0:
+        return
+    _sent_cache[url] = (time.monotonic(), file_id)
+    _sent_cache.move_to_end(url)
+    while len(_sent_cache) > SENT_CACHE_SIZE:
+        _sent_cache.popitem(last=False)
 
 # دالة التحقق
 def is_allowed(user_id: int) -> bool:
     return user_id in ALLOWED_IDS
 
+# decorator للتحقق من الصلاحية قبل أي handler
+def require_allowed(fn):
+    @functools.wraps(fn)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        if user is None or not is_allowed(user.id):
+            await update.effective_message.reply_text(NOT_ALLOWED_TEXT)
+            return
+        return await fn(update, context)
+    return wrapper
+
+# مهام الخلفية: الـ event loop بيمسكها بمرجع ضعيف، فنحتفظ بيها لحد ما تخلص
+_background_tasks: Set[asyncio.Task] = set()
+
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()}")
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+# تشغيل أمر خارجي بدون shell (argv مباشرة)، ويتقتل بعد timeout ثانية
+async def run_cmd(argv: List[str], timeout: float = DOWNLOAD_TIMEOUT_SECONDS) -> Optional[str]:
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"{argv[0]} timed out after {timeout:g}s")
+        return None
+    finally:
+        # timeout أو إلغاء: منسيبش العملية شغالة (وماسكة قفل المستخدم)، ونستناها عشان متفضلش zombie
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    if proc.returncode != 0:
+        logger.error(f"{argv[0]} error: {err.decode('utf-8', errors='ignore')}")
+        return None
+    return out.decode("utf-8", errors="ignore")
+
 # أمر /start
+@require_allowed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_allowed(update.effective_user.id):
-        await update.message.reply_text("❌ غير مسموح لك باستخدام هذا البوت.")
-        return
     await update.message.reply_text("✅ أهلاً! أرسل لي رابط تيك توك أو يوتيوب.")
 
 # التعامل مع الروابط
+@require_allowed
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not is_allowed(user_id):
-        await update.message.reply_text("❌ غير مسموح لك باستخدام هذا البوت.")
+    m = URL_RE.search(update.message.text or "")
+    if not m:
+        await update.message.reply_text("❌ أرسل رابط صالح.")
         return
 
-    url = update.message.text.strip()
+    # طلب ورا طلب بسرعة بيستنى شوية في الطابور، ولو الطلب الأول لسه شغال نرفض
+    lock = _user_locks[user_id]
+    try:
+        await asyncio.wait_for(lock.acquire(), timeout=LOCK_WAIT_SECONDS)
+    except asyncio.TimeoutError:
+        await update.message.reply_text("⏳ عندك طلب شغال، استنى لما يخلص.")
+        return
+
+    try:
+        await download_and_send(update, m.group(0))
+    finally:
+        lock.release()
+
+# التحميل والإرسال
+async def download_and_send(update: Update, url: str):
+    file_id = cache_get(url)
+    if file_id:
+        try:
+            await update.message.reply_video(video=file_id)
+            return
+        except Exception as e:
+            logger.warning(f"Cached file_id send failed, downloading again: {e}")
+            _sent_cache.pop(url, None)
+
     await update.message.reply_text("⏳ جاري التحميل...")
 
+    work_dir = os.path.join(WORK_ROOT, uuid.uuid4().hex)
+    os.makedirs(work_dir)
     try:
         # تحميل الفيديو باستخدام yt-dlp
         cmd = [
             "yt-dlp",
-            "-f", "mp4",
+            "-f", f"b[ext=mp4][filesize<{MAX_MB}M]/b[ext=mp4]",
             "--no-warnings",
-            "--output", "download.%(ext)s",
+            "--no-playlist",
+            "--max-filesize", f"{MAX_MB}M",
+            "--cache-dir", YT_DLP_CACHE_DIR,
+            "--output", os.path.join(work_dir, "download.%(ext)s"),
+            "--print", "after_move:filepath",
+            "--no-simulate",
             url
         ]
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=False,
-            encoding="utf-8",
-            errors="ignore"
-        )
+        result = await run_cmd(cmd)
 
-        if result.returncode != 0:
-            logger.error(f"yt-dlp error: {result.stderr}")
+        if result is None:
             await update.message.reply_text("❌ فشل التحميل. الرابط غير صالح أو حدث خطأ.")
             return
 
-        # البحث عن الملف الناتج
-        for fname in os.listdir("."):
-            if fname.startswith("download"):
-                size_mb = os.path.getsize(fname) / (1024 * 1024)
-                if size_mb > MAX_MB:
-                    await update.message.reply_text(f"⚠️ الملف أكبر من {MAX_MB}MB.")
-                    os.remove(fname)
-                    return
+        # yt-dlp بيطبع مسار الملف النهائي في آخر سطر
+        lines = result.strip().splitlines()
+        if not lines:
+            # --max-filesize بيتخطى التحميل بدون ما يطبع مسار
+            await update.message.reply_text(f"⚠️ الملف أكبر من {MAX_MB}MB أو غير متاح.")
+            return
+
+        fname = lines[-1]
+        if not os.path.isfile(fname):
+            await update.message.reply_text("❌ لم يتم العثور على الملف بعد التحميل.")
+            return
 
-                await update.message.reply_video(video=open(fname, "rb"))
-                os.remove(fname)
-                return
+        if await asyncio.to_thread(os.path.getsize, fname) > MAX_BYTES:
+            await update.message.reply_text(f"⚠️ الملف أكبر من {MAX_MB}MB.")
+            return
 
-        await update.message.reply_text("❌ لم يتم العثور على الملف بعد التحميل.")
+        # InputFile في PTB 20 بيقرا الملف كله، فنقراه في thread بدل الـ event loop
+        with open(fname, "rb") as fh:
+            data = await asyncio.to_thread(fh.read)
+        sent = await update.message.reply_video(video=data, filename=os.path.basename(fname))
+        if sent.video is not None:
+            cache_put(url, sent.video.file_id)
 
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         await update.message.reply_text("⚠️ حصل خطأ غير متوقع.")
+    finally:
+        # التنظيف في الخلفية بدون ما نوقف الـ event loop
+        spawn_background(asyncio.to_thread(shutil.rmtree, work_dir, ignore_errors=True))
+
+# تسخين كاش yt-dlp (player JS) عند بدء التشغيل
+async def warm_ytdlp_cache(application: Application):
+    if not YT_DLP_WARMUP_URL:
+        return
+    # post_init بيشتغل قبل ما الـ Application يبدأ، فـ application.create_task بيحذّر؛ نتابع المهمة بنفسنا
+    spawn_background(run_cmd([
+        "yt-dlp", "--skip-download", "--no-warnings", "--no-playlist",
+        "--cache-dir", YT_DLP_CACHE_DIR, YT_DLP_WARMUP_URL
+    ]))
 
 
 def main():
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(True)
+            .connection_pool_size(64)
+            .pool_timeout(30)
+            .http_version("2")
+            .read_timeout(120)
+            .write_timeout(600)
+            .post_init(warm_ytdlp_cache)
+            .build()
+        )
 
         # Handlers
         application.add_handler(CommandHandler("start", start))
@@ -1,26 +1,54 @@
-import asyncio, subprocess, logging
+import asyncio, logging, os, shutil, tempfile
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
+from typing import AsyncIterator, Optional
+from urllib.parse import urlsplit
 from .config import CONFIG
 
+logger = logging.getLogger(__name__)
+
 MIN_VALID_FILE_SIZE_BYTES = CONFIG["MIN_VALID_FILE_SIZE_BYTES"]
+MAX_CONCURRENT_JOBS = CONFIG["MAX_CONCURRENT_JOBS"]
+MAX_FILE_SIZE_MB = CONFIG["MAX_FILE_SIZE_MB"]
+TIMEOUT_SECONDS = CONFIG["TIMEOUT_SECONDS"]
+
+@lru_cache(maxsize=256)
+def is_tiktok(url: str) -> bool:
+    """هل الرابط من تيك توك (حسب الـ hostname)"""
+    try:
+        host = (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return False
+    # أي subdomain (www/m/vm/vt/us/...) بس مش دومين تاني زي nottiktok.com
+    return host == "tiktok.com" or host.endswith(".tiktok.com")
 
-async def run_blocking_cmd(cmd):
-    """تشغيل أوامر blocking في thread منفصل"""
-    logging.info("Running command: %s", " ".join(cmd))
-    loop = asyncio.get_event_loop()
+async def run_cmd(cmd, timeout: float = TIMEOUT_SECONDS):
+    """تشغيل أمر خارجي بشكل async بدون shell ولا thread (يتقتل بعد timeout ثانية)"""
+    logger.info("Running command: %s", " ".join(cmd))
     try:
-        proc = await loop.run_in_executor(
-            None,
-            lambda: subprocess.run(cmd, capture_output=True, text=True, check=True, encoding="utf-8", errors="ignore")
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
         )
-        logging.info("Command succeeded. Output: %s", proc.stdout[-800:])
-        return proc.stdout
-    except subprocess.CalledProcessError as e:
-        logging.warning("Command failed with code %d. Output: %s", e.returncode, e.stdout[-800:])
-        return None
     except Exception as e:
-        logging.exception("Run cmd error: %s", e)
+        logger.exception("Run cmd error: %s", e)
+        return None
+    try:
+        out, err = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Command timed out after %gs: %s", timeout, cmd[0])
         return None
+    finally:
+        # timeout أو إلغاء: منسيبش العملية شغالة، ونستناها عشان متفضلش zombie
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    stdout = out.decode("utf-8", errors="ignore")
+    if proc.returncode != 0:
+        logger.warning("Command failed with code %d. Output: %s", proc.returncode, err.decode("utf-8", errors="ignore")[-800:])
+        return None
+    logger.info("Command succeeded. Output: %s", stdout[-800:])
+    return stdout
 
 def is_valid_file(p: Path) -> bool:
     """يتأكد من صلاحية الملف"""
@@ -28,3 +56,46 @@ def is_valid_file(p: Path) -> bool:
         return p.is_file() and p.stat().st_size > MIN_VALID_FILE_SIZE_BYTES
     except Exception:
         return False
+
+_scratch_pool: Optional[asyncio.Queue] = None
+
+def _clear_dir(d: Path):
+    """يمسح محتويات المجلد ويسيبه موجود"""
+    with os.scandir(d) as it:
+        for e in it:
+            try:
+                if e.is_dir(follow_symlinks=False):
+                    shutil.rmtree(e.path, ignore_errors=True)
+                else:
+                    os.unlink(e.path)
+            except OSError as ex:
+                logger.warning("Could not remove %s: %s", e.path, ex)
+
+def scratch_root() -> str:
+    """/dev/shm (في الرام) لو فيها مساحة كفاية لكل المهام، وإلا /tmp"""
+    # --max-filesize بيحد كل format لوحده: فيديو + صوت (كل واحد لحد MAX) والملف المدموج (لحد 2×MAX)
+    # يعني 4 أضعاف الحد لكل مهمة في أسوأ حالة (تيك توك: الأصل + النسخة المعدلة = ضعفين)
+    needed = max(1, MAX_CONCURRENT_JOBS) * 4 * MAX_FILE_SIZE_MB * 1024 * 1024
+    try:
+        if shutil.disk_usage("/dev/shm").free >= needed:
+            return "/dev/shm"
+    except OSError:
+        pass
+    return "/tmp"
+
+@asynccontextmanager
+async def scratch_dir() -> AsyncIterator[Path]:
+    """يحجز مجلد عمل من pool ثابت (وبيحدد عدد المهام المتزامنة)"""
+    global _scratch_pool
+    if _scratch_pool is None:
+        _scratch_pool = asyncio.Queue()
+        root = scratch_root()
+        logger.info("Scratch dirs under %s", root)
+        for i in range(max(1, MAX_CONCURRENT_JOBS)):
+            _scratch_pool.put_nowait(Path(tempfile.mkdtemp(prefix=f"tg_dl_{i}_", dir=root)))
+    d = await _scratch_pool.get()
+    try:
+        yield d
+    finally:
+        await asyncio.to_thread(_clear_dir, d)
+        _scratch_pool.put_nowait(d)